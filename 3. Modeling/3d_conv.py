@@ -3,10 +3,15 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.optim as optim
-from torch.utils.data import Dataset, DataLoader
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from torch.utils.data import Dataset, DataLoader, ConcatDataset
 from sklearn.metrics import confusion_matrix, accuracy_score, precision_recall_fscore_support
 import torchsummary
 import random
+import os
+import copy
+import gc
+from concurrent.futures import ThreadPoolExecutor
 
 # 시드 설정 함수
 def set_seed(seed):
@@ -14,67 +19,121 @@ def set_seed(seed):
     np.random.seed(seed)
     torch.manual_seed(seed)
     torch.cuda.manual_seed_all(seed)
-    torch.backends.cudnn.deterministic = True
-    torch.backends.cudnn.benchmark = False
+
+# cuDNN 설정 함수
+# 입력 shape이 (96, 7500)으로 고정이므로 benchmark 모드로 가장 빠른 Conv3d 알고리즘을 한 번 찾아 재사용
+# 재현성이 필요하면 PVDF_DETERMINISTIC=1 로 실행
+def set_cudnn(deterministic=False):
+    torch.backends.cudnn.deterministic = deterministic
+    torch.backends.cudnn.benchmark = not deterministic
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 print(f"Using device: {device}")
 
+# AMP(FP16 autocast + GradScaler)는 CUDA에서만 사용
+use_amp = device.type == "cuda"
+# 데이터는 FP16으로 저장 → AMP에서는 그대로 conv에 입력, CPU에서는 FP32로 변환
+input_dtype = torch.float16 if use_amp else torch.float32
+
 class PVDFDataset3D(Dataset):
-    def __init__(self, data, labels):
-        self.data = data
+    def __init__(self, data_path, labels):
+        # .npy 경로만 저장하고 mmap은 각 프로세스(worker)에서 처음 접근할 때 연다
+        # Windows(spawn)에서 worker로 pickle될 때 memmap이 통째로 복사되지 않도록 하기 위함
+        self.data_path = data_path
         self.labels = labels
+        self.data = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['data'] = None  # 열린 mmap은 넘기지 않고 worker에서 다시 연다
+        return state
 
     def __len__(self):
         return len(self.labels)
 
     def __getitem__(self, idx):
-        x = torch.tensor(self.data[idx], dtype=torch.float32).unsqueeze(0).to(device)  # 데이터를 GPU로 이동
-        y = torch.tensor(self.labels[idx], dtype=torch.long).to(device) 
-        return x, y
+        if self.data is None:
+            self.data = np.load(self.data_path, mmap_mode='r')
+        return self.data[idx], self.labels[idx]  # NumPy view, 텐서 변환은 collate_pvdf에서 배치 단위로
+
+# 배치 단위 collate: 샘플마다 텐서를 만드는 대신 한 번의 np.stack으로 (B, 96, 7500) 배치 생성
+def collate_pvdf(batch):
+    data, labels = zip(*batch)
+    x = torch.from_numpy(np.stack(data))
+    y = torch.from_numpy(np.array(labels, dtype=np.int64))
+    return x, y
+
+# 전처리 캐시 생성: .mat(HDF5)을 한 번만 읽어 (samples, 96, 7500) FP16 데이터와 레이블을 .npy로 저장
+# HDF5에 저장된 레이아웃 그대로 두어 transpose 없이 시간축이 연속 → 모델의 시간축 Conv1d 입력이 복사 없는 view
+def build_cache(file_path, data_path, labels_path):
+    sample_slice = np.s_[10:90, :, :]
+
+    # chunk cache를 키워 chunk 단위로 한 번에 읽음
+    with h5py.File(file_path, 'r', rdcc_nbytes=256 * 1024 * 1024) as f:
+        dsets = [f[f['label_data'][i][0]] for i in range(4)]  # 4개의 클래스, 각 (samples, 96, 7500)
+        counts = [len(range(*sample_slice[0].indices(dset.shape[0]))) for dset in dsets]
+
+        # 최종 배열을 디스크에 바로 할당 (중간에 중단되면 .tmp만 남으므로 다음 실행에서 다시 생성)
+        data = np.lib.format.open_memmap(data_path + '.tmp', mode='w+', dtype=np.float16, shape=(sum(counts), 96, 7500))
+        labels = np.empty((sum(counts),), dtype=np.int8)  # 클래스 3개라 int8로 충분
+
+        # 재사용 버퍼에 읽은 뒤 FP16으로 한 번만 복사
+        buf = np.empty((max(counts), 96, 7500), dtype=np.float32)
+        offset = 0
+        for i, (dset, num_samples) in enumerate(zip(dsets, counts)):
+            # 클래스당 한 번의 HDF5 호출로 버퍼에 직접 읽기
+            dset.read_direct(buf, source_sel=sample_slice, dest_sel=np.s_[:num_samples])
+
+            # 연속 메모리 그대로 FP16 변환 복사
+            data[offset:offset + num_samples] = buf[:num_samples]
+
+            # 레이블 할당
+            label = 1 if i == 1 or i == 2 else 2 if i == 3 else 0
+
+            labels[offset:offset + num_samples] = label
+            offset += num_samples
+
+        data.flush()
+        del data
+
+    np.save(labels_path, labels)
+    os.replace(data_path + '.tmp', data_path)
 
 # 데이터 로드
 def load_data(subject_files, group_indices=None):
-    data_list = []
-    labels_list = []
+    datasets = []
 
     for idx in (group_indices if group_indices is not None else range(len(subject_files))):
         file_path = subject_files[idx]
-        with h5py.File(file_path, 'r') as f:
-            for i in range(4):  # 각 셀을 순회 (4개의 클래스)
-                data_ref = f['label_data'][i][0]
-                data = np.array(f[data_ref][10:90, :, :]).T  # 데이터를 불러오고 transpose
-
-                # Reshape 및 Transpose: (7500, 96, samples) -> (samples, 7500, 24, 4)
-                num_samples = data.shape[2]
-                reshaped_data = data.reshape((7500, 24, 4, num_samples))  # (7500, 24, 4, samples)
-                reshaped_data = np.transpose(reshaped_data, (3, 0, 1, 2))  # (samples, 7500, 24, 4)
+        data_path = os.path.splitext(file_path)[0] + '_data_96x7500.npy'
+        labels_path = os.path.splitext(file_path)[0] + '_labels.npy'
 
-                # 레이블 할당
-                label = 1 if i == 1 or i == 2 else 2 if i == 3 else 0
+        # 첫 실행에서만 HDF5를 읽어 캐시 생성 (전처리가 바뀌면 캐시 파일을 지우고 다시 실행)
+        if not os.path.exists(data_path):
+            build_cache(file_path, data_path, labels_path)
 
-                data_list.append(reshaped_data)
-                labels_list.append(np.full((reshaped_data.shape[0],), label))  
-
-    # 데이터를 하나의 배열로 결합
-    data = np.concatenate(data_list, axis=0)
-    labels = np.concatenate(labels_list, axis=0)
+        # 데이터는 mmap으로 열어 배치에 필요한 샘플만 읽음 (PVDFDataset3D에서 지연 로드)
+        datasets.append(PVDFDataset3D(data_path, np.load(labels_path)))
 
     # Dataset 생성
-    dataset = PVDFDataset3D(data, labels)
+    dataset = ConcatDataset(datasets)
     return dataset
 
 # 3D CNN 모델 정의
 class CNN3D(nn.Module):
+    # 평가 시 하나의 Conv로 합칠 (Conv, BatchNorm) 쌍
+    conv_bn_pairs = (('conv1_space', 'bn1'), ('conv2', 'bn2'), ('conv3', 'bn3'))
+
     def __init__(self):
         super(CNN3D, self).__init__()
-        self.conv1 = nn.Conv3d(1, 16, kernel_size=(125, 3, 2), stride=(25, 2, 2), padding=(7, 2, 2))
+        # 첫 번째 Conv3d(1채널 입력)를 시간축 1D conv + 24x4 격자 공간 conv로 분리
+        # MaxPool 대신 stride를 키워 다운샘플링 → 가장 큰 activation에 대한 별도 pooling 패스 제거
+        self.conv1_time = nn.Conv1d(1, 16, kernel_size=125, stride=50, padding=7)  # 7500 -> 148
+        self.conv1_space = nn.Conv3d(16, 16, kernel_size=(1, 4, 2), stride=(1, 4, 2))  # -> (148, 6, 2), 시간축 커널 1 = 시점별 2D conv
         self.bn1 = nn.BatchNorm3d(16)
-        self.pool1 = nn.MaxPool3d((2, 2, 2))
 
-        self.conv2 = nn.Conv3d(16, 32, kernel_size=(25, 2, 2), stride=(5, 2, 1), padding=(7, 2, 2))
+        self.conv2 = nn.Conv3d(16, 32, kernel_size=(25, 4, 2), stride=(10, 4, 1), padding=(7, 1, 2))  # -> (14, 2, 5)
         self.bn2 = nn.BatchNorm3d(32)
-        self.pool2 = nn.MaxPool3d((2, 2, 1))
 
         self.conv3 = nn.Conv3d(32, 64, kernel_size=(3, 2, 2),  stride=(1, 1, 1), padding=(2, 2, 2))
         self.bn3 = nn.BatchNorm3d(64)
@@ -86,8 +145,14 @@ class CNN3D(nn.Module):
         self.fc = nn.Linear(64, 3)
 
     def forward(self, x):
-        x = self.pool1(torch.relu(self.bn1(self.conv1(x))))
-        x = self.pool2(torch.relu(self.bn2(self.conv2(x))))
+        b, hw, t = x.size()  # (B, 96, 7500), 96 = 24(주파수) x 4(채널)
+        # 96개 (주파수 x 채널) 위치를 배치로 펼쳐 시간축 1D conv 적용 (시간축이 연속이라 복사 없는 view)
+        x = x.view(b * hw, 1, t)  # (B*96, 1, 7500)
+        x = self.conv1_time(x)  # (B*96, 16, 148)
+        # (B, 16, 148, 24, 4)로 바꾸면서 NDHWC(channels_last_3d) 레이아웃으로 변환 → cuDNN이 내부 transpose 없이 Tensor Core 커널 사용
+        x = x.view(b, 24, 4, x.size(1), x.size(2)).permute(0, 3, 4, 1, 2).contiguous(memory_format=torch.channels_last_3d)
+        x = torch.relu(self.bn1(self.conv1_space(x)))
+        x = torch.relu(self.bn2(self.conv2(x)))
         x = self.pool3(torch.relu(self.bn3(self.conv3(x))))
         x = self.global_avg_pool(x)
         x = x.view(x.size(0), -1)  # Flatten
@@ -95,35 +160,57 @@ class CNN3D(nn.Module):
         x = self.fc(x)
         return x
 
+# 평가용 모델 생성: BatchNorm을 앞의 Conv 가중치에 합쳐 BN 커널과 activation 읽기/쓰기를 제거
+def fuse_conv_bn(model):
+    fused_model = copy.deepcopy(model).eval()
+    for conv_name, bn_name in fused_model.conv_bn_pairs:
+        setattr(fused_model, conv_name, fuse_conv_bn_eval(getattr(fused_model, conv_name), getattr(fused_model, bn_name)))
+        setattr(fused_model, bn_name, nn.Identity())
+    return fused_model.to(memory_format=torch.channels_last_3d)
+
 # 학습 함수
-def train_model(model, train_loader_list, criterion, optimizer, scheduler, validation_loader, num_epochs=10):
+def train_model(model, train_loader, criterion, optimizer, scheduler, scaler, validation_loader, num_epochs=10, accumulation_steps=1, compile_model=False):
     model.train()
     best_validation_loss = float('inf')  # 베스트 모델 저장을 위한 기준
 
+    # Inductor로 BN+ReLU 등 element-wise 연산을 fuse하고 op별 Python dispatch 오버헤드 제거
+    # Inductor GPU 백엔드는 Triton이 필요해 Windows에서는 쓸 수 없으므로 PVDF_COMPILE=1 일 때만 사용 (기본은 eager)
+    # 파라미터는 model과 공유하므로 저장/평가는 원래 model로 수행
+    compiled_model = torch.compile(model, mode="max-autotune") if compile_model else model
+
     for epoch in range(num_epochs):
-        total_correct = 0
+        # loss/정답 수는 GPU 텐서로 누적해 배치마다 .item() 동기화가 일어나지 않도록 함
+        total_correct = torch.zeros((), dtype=torch.long, device=device)
         total_samples = 0
-        running_loss = 0.0
+        running_loss = torch.zeros((), device=device)
         total_batches = 0
+        optimizer.zero_grad()
 
-        # 순차적으로 학습
-        for train_loader in train_loader_list:
-            for inputs, labels in train_loader:
-                optimizer.zero_grad()
+        # 전체 학습 그룹을 하나의 DataLoader로 섞어서 학습
+        for step, (inputs, labels) in enumerate(train_loader):
+            inputs = inputs.to(device, dtype=input_dtype, non_blocking=True)
+            labels = labels.to(device, non_blocking=True)
 
-                outputs = model(inputs)
+            # Mixed precision: Conv3d는 FP16(Tensor Core), BatchNorm은 autocast가 FP32로 유지
+            with torch.amp.autocast(device.type, dtype=torch.float16, enabled=use_amp):
+                outputs = compiled_model(inputs)
                 loss = criterion(outputs, labels)
-                loss.backward()
-                optimizer.step()
+            scaler.scale(loss / accumulation_steps).backward()
+
+            # accumulation_steps 배치마다 (에폭의 마지막 배치 포함) 한 번 업데이트
+            if (step + 1) % accumulation_steps == 0 or step + 1 == len(train_loader):
+                scaler.step(optimizer)
+                scaler.update()
+                optimizer.zero_grad()
 
-                running_loss += loss.item()
-                _, predicted = torch.max(outputs, 1)
-                total_samples += labels.size(0)
-                total_correct += (predicted == labels).sum().item()
-                total_batches += 1
+            running_loss += loss.detach()
+            _, predicted = torch.max(outputs, 1)
+            total_samples += labels.size(0)
+            total_correct += (predicted == labels).sum()
+            total_batches += 1
 
-        average_loss = running_loss / total_batches
-        train_accuracy = total_correct / total_samples * 100
+        average_loss = running_loss.item() / total_batches
+        train_accuracy = total_correct.item() / total_samples * 100
         print(f'Epoch {epoch + 1}, Train Accuracy: {train_accuracy:.2f}%, Loss: {average_loss:.4f}')
 
         validation_loss, validation_accuracy = validate_model(model, validation_loader, criterion)
@@ -138,37 +225,47 @@ def train_model(model, train_loader_list, criterion, optimizer, scheduler, valid
             print(f"Best model saved at epoch {epoch + 1} with validation loss: {validation_loss:.4f}")
                   
 def validate_model(model, validation_loader, criterion):
-    model.eval()
-    total_correct = 0
+    # 학습 중인 model은 train 모드 그대로 두고, fuse_conv_bn이 만든 eval 복사본으로만 평가
+    fused_model = fuse_conv_bn(model)
+    total_correct = torch.zeros((), dtype=torch.long, device=device)
     total_samples = 0
-    running_loss = 0.0
+    running_loss = torch.zeros((), device=device)
     total_batches = 0
 
-    with torch.no_grad():
+    with torch.inference_mode():  # no_grad보다 autograd 버전 카운터/view 메타데이터 추적까지 생략
         for inputs, labels in validation_loader:
-            outputs = model(inputs)
-            loss = criterion(outputs, labels)
-            running_loss += loss.item()
+            inputs = inputs.to(device, dtype=input_dtype, non_blocking=True)
+            labels = labels.to(device, non_blocking=True)
+            with torch.amp.autocast(device.type, dtype=torch.float16, enabled=use_amp):
+                outputs = fused_model(inputs)
+                loss = criterion(outputs, labels)
+            running_loss += loss.detach()
             _, predicted = torch.max(outputs, 1)
             total_samples += labels.size(0)
-            total_correct += (predicted == labels).sum().item()
+            total_correct += (predicted == labels).sum()
             total_batches += 1
 
-    validation_loss = running_loss / total_batches
-    validation_accuracy = total_correct / total_samples * 100
+    validation_loss = running_loss.item() / total_batches
+    validation_accuracy = total_correct.item() / total_samples * 100
     return validation_loss, validation_accuracy
 
 def test_model(model, test_loader):
     model.eval()
+    fused_model = fuse_conv_bn(model)
     all_labels = []
     all_preds = []
 
-    with torch.no_grad():
+    with torch.inference_mode():
         for inputs, labels in test_loader:
-            outputs = model(inputs)
+            inputs = inputs.to(device, dtype=input_dtype, non_blocking=True)
+            with torch.amp.autocast(device.type, dtype=torch.float16, enabled=use_amp):
+                outputs = fused_model(inputs)
             _, predicted = torch.max(outputs, 1)
-            all_labels.extend(labels.cpu().numpy())
-            all_preds.extend(predicted.cpu().numpy())
+            all_labels.append(labels)
+            all_preds.append(predicted)  # GPU에 모아 두고 마지막에 한 번만 CPU로 복사
+
+    all_labels = torch.cat(all_labels).numpy()
+    all_preds = torch.cat(all_preds).cpu().numpy()
 
     cm = confusion_matrix(all_labels, all_preds)
     test_accuracy = accuracy_score(all_labels, all_preds) * 100
@@ -180,38 +277,61 @@ def test_model(model, test_loader):
 
     return test_accuracy
 
-def train_and_evaluate(subject_files, num_epochs=10, patience=5):
+def train_and_evaluate(subject_files, num_epochs=10, patience=5, batch_size=64, accumulation_steps=1, num_workers=4):
+    set_cudnn(deterministic=os.environ.get("PVDF_DETERMINISTIC") == "1")
+    compile_model = os.environ.get("PVDF_COMPILE") == "1"
     random.shuffle(subject_files)
 
     test_subjects = subject_files[:6]  # 검증용
     validation_subjects = subject_files[6:12]  # 테스트용
     train_subjects = subject_files[12:]  # 학습용
 
+    # DataLoader 공통 설정: worker에서 배치를 만들고 pinned memory에 올려 배치당 한 번의 non_blocking H2D 복사
+    loader_kwargs = dict(collate_fn=collate_pvdf, num_workers=num_workers, pin_memory=device.type == "cuda", persistent_workers=num_workers > 0)
+
+    # AMP로 activation 메모리가 줄어든 만큼 배치를 키워 Conv3d 커널 launch 비용을 분산
+    # 더 큰 유효 배치가 필요하면 accumulation_steps로 gradient 누적
     validation_dataset = load_data(validation_subjects)
-    validation_loader = DataLoader(validation_dataset, batch_size=16, shuffle=False)
+    validation_loader = DataLoader(validation_dataset, batch_size=batch_size, shuffle=False, **loader_kwargs)
 
-    model = CNN3D().to(device)
+    model = CNN3D().to(device, memory_format=torch.channels_last_3d)
 
     criterion = nn.CrossEntropyLoss()
 
     optimizer = optim.Adam(model.parameters(), lr=0.01, weight_decay=1e-4)
     scheduler = optim.lr_scheduler.ReduceLROnPlateau(optimizer, mode='min', patience=3, factor=0.1)
+    scaler = torch.amp.GradScaler(device.type, enabled=use_amp)
 
     train_groups = np.array_split(np.arange(len(train_subjects)), 6)
-    train_loader_list = [DataLoader(load_data(train_subjects, group), batch_size=16, shuffle=True) for group in train_groups]
+    train_dataset = ConcatDataset([load_data(train_subjects, group) for group in train_groups])
+    # torch.compile 사용 시에만 마지막 짧은 배치를 버려 배치 shape을 고정 (재컴파일 방지), eager에서는 모든 샘플 사용
+    train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True, drop_last=compile_model, **loader_kwargs)
+
+    # 테스트 데이터는 학습 중 백그라운드 스레드에서 미리 로드 (HDF5 I/O를 GPU 학습 뒤에 숨김)
+    # 파일 단위로 나눠 제출해 학습이 중단되면 아직 시작하지 않은 캐시 생성은 취소
+    executor = ThreadPoolExecutor(max_workers=1)
+    try:
+        test_futures = [executor.submit(load_data, test_subjects, [idx]) for idx in range(len(test_subjects))]
+
+        train_model(model, train_loader, criterion, optimizer, scheduler, scaler, validation_loader, num_epochs, accumulation_steps, compile_model)
+
+        test_dataset = ConcatDataset([future.result() for future in test_futures])
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
 
-    train_model(model, train_loader_list, criterion, optimizer, scheduler, validation_loader, num_epochs)
+    # 학습/검증 DataLoader(persistent worker 포함)와 mmap을 테스트 전에 해제
+    del train_loader, train_dataset, validation_loader, validation_dataset
+    gc.collect()
 
     # 테스트 성능 평가
     print("\nTest Performance:")
-    test_dataset = load_data(test_subjects)
-    test_loader = DataLoader(test_dataset, batch_size=16, shuffle=False)
+    test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False, **loader_kwargs)
     test_accuracy = test_model(model, test_loader)
     
     print(f"Final Test Accuracy: {test_accuracy:.2f}%")
 
     print("\nModel Summary:")
-    torchsummary.summary(CNN3D().to(device), (1, 7500, 24, 4), device=str(device))
+    torchsummary.summary(CNN3D().to(device), (96, 7500), device=str(device))
 
 if __name__ == "__main__":
     set_seed(42)